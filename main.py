@@ -1,11 +1,24 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+import orjson
 import threading
-import time
+import json
+import random
 import uuid
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import google.generativeai as genai
-from datetime import datetime, timedelta
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerThreadPool
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.triggers.cron import CronTrigger
+from dataclasses import dataclass
+from typing import Optional
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
 # === Load .env ===
@@ -18,15 +31,93 @@ if not GOOGLE_API_KEY:
 
 # === Configure Gemini ===
 genai.configure(api_key=GOOGLE_API_KEY)
+_GEMINI_MODEL = genai.GenerativeModel("gemini-2.0-flash")
 
 # === Flask app ===
 app = Flask(__name__)
+app.json.sort_keys = False
 
 # === In-memory storage ===
-SESSIONS = {}
+@dataclass(slots=True)
+class Session:
+    session_id: str
+    user_id: str
+    channel_id: str
+    start: datetime
+    end: datetime
+    duration: int
+    break_: int
+    status: str
+    completed_at: Optional[datetime] = None
+
+    def to_json(self):
+        return {
+            "session_id": self.session_id,
+            "user_id": self.user_id,
+            "channel_id": self.channel_id,
+            "start": self.start,
+            "end": self.end,
+            "duration": self.duration,
+            "break": self.break_,
+            "status": self.status,
+            "completed_at": self.completed_at,
+        }
+
+# Single-key get/set on these dicts is atomic under the GIL; `lock` only
+# guards compound read-modify-write blocks.
+SESSIONS = OrderedDict()  # LRU order: oldest first
+MAX_SESSIONS = 100_000
+USER_SESSIONS = defaultdict(deque)  # user_id -> session_ids in start order
 USER_SUMMARIES = {}
 lock = threading.Lock()
 
+# === Single background scheduler for session/break timers ===
+scheduler = BackgroundScheduler(executors={"default": SchedulerThreadPool(max_workers=4)})
+
+def cancel_job(job_id: str):
+    try:
+        scheduler.remove_job(job_id)
+    except JobLookupError:
+        pass
+
+# === Session store helpers ===
+def store_session(session):
+    """Insert a session and evict least-recently-used ones beyond MAX_SESSIONS."""
+    with lock:
+        SESSIONS[session.session_id] = session
+        USER_SESSIONS[session.user_id].append(session.session_id)
+        while len(SESSIONS) > MAX_SESSIONS:
+            old_sid, old = SESSIONS.popitem(last=False)
+            ids = USER_SESSIONS.get(old.user_id)
+            if ids is not None:
+                ids.remove(old_sid)
+                if not ids:
+                    del USER_SESSIONS[old.user_id]
+
+def get_session(session_id):
+    """Look up a session and mark it as recently used."""
+    session = SESSIONS.get(session_id)
+    if session is not None:
+        try:
+            SESSIONS.move_to_end(session_id)
+        except KeyError:
+            pass  # evicted concurrently
+    return session
+
+def user_sessions_of(user_id):
+    return [s for s in (SESSIONS.get(sid) for sid in tuple(USER_SESSIONS.get(user_id, ()))) if s is not None]
+
+# === Shared HTTP session for Telex (keep-alive + pooling) ===
+_session = requests.Session()
+_session.headers.update({"Content-Type": "application/json"})
+_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.1),  # connect errors only; POST is not retried on status
+)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
 # === Helper function to send to Telex ===
 def send_to_telex(channel_id: str, message: str):
     payload = {"channel_id": channel_id, "text": message}
@@ -34,43 +125,227 @@ def send_to_telex(channel_id: str, message: str):
         app.logger.info(f"(DEBUG) Would send to Telex: {payload}")
         return
     try:
-        requests.post(TELEX_WEBHOOK_URL, json=payload, timeout=5)
+        _session.post(TELEX_WEBHOOK_URL, json=payload, timeout=5)
     except Exception as e:
         app.logger.error(f"Failed to send message to Telex: {e}")
 
+def _json_default(obj):
+    if isinstance(obj, Session):
+        return obj.to_json()
+    raise TypeError
+
+def fast_json(obj):
+    """Serialize with orjson (handles datetimes natively) into a Flask response."""
+    return Response(
+        orjson.dumps(obj, default=_json_default, option=orjson.OPT_PASSTHROUGH_DATACLASS),
+        mimetype="application/json",
+    )
+
 # === AI helper ===
+_AI_FALLBACK = "⚠️ AI failed to respond."
+
+# Prompt templates; cached replies are keyed on (template, params) so the
+# hot path hashes a constant string and a few ints instead of a formatted prompt.
+_PROMPT_START = "Give a motivating start message for a {duration}-minute focus session."
+_PROMPT_DAILY_SUMMARY = (
+    "Create an encouraging daily summary for someone who completed "
+    "{total_sessions} sessions totaling about {minutes_bucket} minutes."
+)
+
+@lru_cache(maxsize=512)
+def _generate_template_cached(template: str, params: tuple):
+    return _GEMINI_MODEL.generate_content(template.format(**dict(params))).text.strip()
+
 def ai_generate(message: str):
     """Generate AI message using Gemini."""
     try:
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        response = model.generate_content(message)
-        return response.text.strip()
+        return _GEMINI_MODEL.generate_content(message).text.strip()
     except Exception as e:
         app.logger.error(f"AI generation failed: {e}")
-        return "⚠️ AI failed to respond."
+        return _AI_FALLBACK
+
+def ai_generate_template(template: str, **params):
+    """Generate AI message from a prompt template (cached per template and params)."""
+    try:
+        return _generate_template_cached(template, tuple(params.items()))
+    except Exception as e:
+        app.logger.error(f"AI generation failed: {e}")
+        return _AI_FALLBACK
+
+# === Background AI + Telex dispatch ===
+_IO_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="telex-io")
+_IO_BACKLOG_LIMIT = 100
+
+# === Per-channel Telex batching ===
+# Completion notifications are coalesced per channel: the first queued message
+# arms a short flush timer, and a full batch flushes immediately. The webhook
+# takes one text per post, so a flush posts each message in order over the
+# shared keep-alive session.
+_TELEX_Q = defaultdict(list)
+_TELEX_Q_LOCK = threading.Lock()
+_TELEX_BATCH_DELAY = 0.2  # seconds
+_TELEX_BATCH_MAX = 10
+
+def flush_telex(channel_id: str):
+    with _TELEX_Q_LOCK:
+        texts = _TELEX_Q.pop(channel_id, None)
+    for text in texts or ():
+        send_to_telex(channel_id, text)
+
+def _flush_telex_later(channel_id: str):
+    _IO_POOL.submit(flush_telex, channel_id)
+
+def queue_telex(channel_id: str, message: str):
+    with _TELEX_Q_LOCK:
+        pending = _TELEX_Q[channel_id]
+        pending.append(message)
+        size = len(pending)
+    if size >= _TELEX_BATCH_MAX:
+        _IO_POOL.submit(flush_telex, channel_id)
+    elif size == 1:
+        scheduler.add_job(
+            _flush_telex_later,
+            "date",
+            run_date=datetime.now(timezone.utc) + timedelta(seconds=_TELEX_BATCH_DELAY),
+            args=[channel_id],
+            misfire_grace_time=None,
+            coalesce=True,
+        )
+
+def _ai_then_send(
+    channel_id: str, template: str, params: dict, prefix: str, suffix: str = "", batch: bool = False, cached: bool = True
+):
+    ai_msg = ai_generate_template(template, **params) if cached else ai_generate(template.format(**params))
+    (queue_telex if batch else send_to_telex)(channel_id, f"{prefix}{ai_msg}{suffix}")
+
+def dispatch_ai_message(
+    channel_id: str,
+    template: str,
+    prefix: str,
+    suffix: str = "",
+    batch: bool = False,
+    params: dict = None,
+    cached: bool = True,
+):
+    """Queue AI generation + Telex post off the calling thread.
+
+    When the pool is backed up, skip the AI call and send the static text only.
+    With `batch`, the post goes through the per-channel batch queue; with
+    `cached=False`, the reply is generated fresh instead of memoised.
+    """
+    if _IO_POOL._work_queue.qsize() > _IO_BACKLOG_LIMIT:
+        text = f"{prefix.rstrip()}{suffix}"
+        if batch:
+            queue_telex(channel_id, text)
+        else:
+            _IO_POOL.submit(send_to_telex, channel_id, text)
+        return
+    _IO_POOL.submit(_ai_then_send, channel_id, template, params or {}, prefix, suffix, batch, cached)
+
+# === Pre-generated message variants for the fixed prompts ===
+_VARIANT_PROMPTS = {
+    "focus_done": "Generate a short motivational message for completing a focus session.",
+    "break_done": "Send a cheerful message to start a new focus session after a break.",
+    "stop_early": "Encourage the user kindly after stopping a focus session early.",
+}
+_VARIANT_COUNT = 20
+_VARIANTS = {}
+_VARIANT_RETRY_BASE = 30  # seconds
+_VARIANT_RETRY_MAX = 3600
+
+def _load_variants(attempt: int = 0):
+    """Fill _VARIANTS, retrying with exponential backoff until every tag has variants."""
+    _fetch_variants()
+    if all(tag in _VARIANTS for tag in _VARIANT_PROMPTS):
+        return
+    delay = min(_VARIANT_RETRY_BASE * 2 ** attempt, _VARIANT_RETRY_MAX)
+    scheduler.add_job(
+        _IO_POOL.submit,
+        "date",
+        run_date=datetime.now(timezone.utc) + timedelta(seconds=delay),
+        args=[_load_variants, attempt + 1],
+        misfire_grace_time=None,
+    )
+
+def _fetch_variants():
+    """One batched Gemini call returning a JSON object of arrays."""
+    prompt = (
+        f"For each key below, write {_VARIANT_COUNT} different one-sentence messages. "
+        "Reply with only a JSON object mapping each key to an array of strings.\n"
+        + "\n".join(f"{tag}: {p}" for tag, p in _VARIANT_PROMPTS.items())
+    )
+    try:
+        raw = _GEMINI_MODEL.generate_content(
+            prompt, generation_config={"response_mime_type": "application/json"}
+        ).text
+        data = json.loads(raw)
+    except Exception as e:
+        app.logger.error(f"Variant generation failed: {e}")
+        return
+    if not isinstance(data, dict):
+        app.logger.error(f"Variant generation returned a non-object payload: {raw!r}")
+        return
+    for tag in _VARIANT_PROMPTS:
+        items = data.get(tag)
+        if not isinstance(items, list):
+            app.logger.error(f"Variant generation returned no list for {tag!r}: {items!r}")
+            continue
+        options = [o.strip() for o in items if isinstance(o, str) and o.strip()]
+        if options:
+            _VARIANTS[tag] = options
+
+def dispatch_variant_message(channel_id: str, tag: str, prefix: str, suffix: str = "", batch: bool = False):
+    """Send a pre-generated variant for `tag`, falling back to a fresh AI call until they are loaded."""
+    options = _VARIANTS.get(tag)
+    if not options:
+        dispatch_ai_message(channel_id, _VARIANT_PROMPTS[tag], prefix, suffix, batch, cached=False)
+        return
+    text = f"{prefix}{random.choice(options)}{suffix}"
+    if batch:
+        queue_telex(channel_id, text)
+    else:
+        _IO_POOL.submit(send_to_telex, channel_id, text)
 
 # === Focus session handling ===
 def end_focus(session_id):
+    session = get_session(session_id)
+    if not session:
+        return
     with lock:
-        session = SESSIONS.get(session_id)
-        if not session:
+        if session.status != "running":
             return
-        session["status"] = "focus_completed"
-    ai_msg = ai_generate("Generate a short motivational message for completing a focus session.")
-    send_to_telex(session["channel_id"], f"⏰ Focus session finished for <@{session['user_id']}>! {ai_msg}\nTime for a {session['break']} minute break.")
-    t = threading.Timer(session["break"] * 60, end_break, args=(session_id,))
-    t.daemon = True
-    t.start()
+        session.status = "focus_completed"
+    dispatch_variant_message(
+        session.channel_id,
+        "focus_done",
+        f"⏰ Focus session finished for <@{session.user_id}>! ",
+        f"\nTime for a {session.break_} minute break.",
+        batch=True,
+    )
+    scheduler.add_job(
+        end_break,
+        "date",
+        run_date=session.end + timedelta(minutes=session.break_),
+        args=[session_id],
+        id=f"{session_id}:brk",
+        misfire_grace_time=60,
+    )
 
 def end_break(session_id):
+    session = get_session(session_id)
+    if not session:
+        return
     with lock:
-        session = SESSIONS.get(session_id)
-        if not session:
+        if session.status != "focus_completed":
             return
-        session["status"] = "completed"
-        session["completed_at"] = datetime.utcnow().isoformat()
-    ai_msg = ai_generate("Send a cheerful message to start a new focus session after a break.")
-    send_to_telex(session["channel_id"], f"✅ Break over — {ai_msg}")
+        session.status = "completed"
+        session.completed_at = datetime.now(timezone.utc)
+    dispatch_variant_message(
+        session.channel_id,
+        "break_done",
+        "✅ Break over — ",
+        batch=True,
+    )
 
 # === Routes ===
 
@@ -85,32 +360,33 @@ def start_focus():
     if not user_id or not channel_id:
         return jsonify({"error": "user_id and channel_id required"}), 400
 
-    session_id = str(uuid.uuid4())
-    start = datetime.now()
+    session_id = uuid.uuid4().hex
+    start = datetime.now(timezone.utc)
     end = start + timedelta(minutes=duration)
 
-    session = {
-        "session_id": session_id,
-        "user_id": user_id,
-        "channel_id": channel_id,
-        "start": start.isoformat(),
-        "end": end.isoformat(),
-        "duration": duration,
-        "break": brk,
-        "status": "running",
-    }
+    session = Session(
+        session_id=session_id,
+        user_id=user_id,
+        channel_id=channel_id,
+        start=start,
+        end=end,
+        duration=duration,
+        break_=brk,
+        status="running",
+    )
 
-    with lock:
-        SESSIONS[session_id] = session
+    store_session(session)
 
-    ai_msg = ai_generate(f"Give a motivating start message for a {duration}-minute focus session.")
-    send_to_telex(channel_id, f"🚀 <@{user_id}> started a {duration}-minute focus session.\n{ai_msg}")
+    dispatch_ai_message(
+        channel_id,
+        _PROMPT_START,
+        f"🚀 <@{user_id}> started a {duration}-minute focus session.\n",
+        params={"duration": duration},
+    )
 
-    t = threading.Timer(duration * 60, end_focus, args=(session_id,))
-    t.daemon = True
-    t.start()
+    scheduler.add_job(end_focus, "date", run_date=end, args=[session_id], id=session_id, misfire_grace_time=60)
 
-    return jsonify({"session_id": session_id, "status": "started"})
+    return jsonify({"session_id": session_id, "status": "started"}), 202
 
 @app.route("/stop_focus", methods=["POST"])
 def stop_focus():
@@ -121,29 +397,41 @@ def stop_focus():
     if not session_id and not user_id:
         return jsonify({"error": "session_id or user_id required"}), 400
 
-    with lock:
-        if session_id:
-            session = SESSIONS.get(session_id)
-            if not session:
-                return jsonify({"error": "session not found"}), 404
-            session["status"] = "stopped"
-            ai_msg = ai_generate("Encourage the user kindly after stopping a focus session early.")
-            send_to_telex(session["channel_id"], f"🛑 Focus session stopped for <@{session['user_id']}>.\n{ai_msg}")
-            return jsonify({"status": "stopped"})
-        else:
-            for sid, s in list(SESSIONS.items())[::-1]:
-                if s["user_id"] == user_id and s["status"] == "running":
-                    s["status"] = "stopped"
-                    ai_msg = ai_generate("Encourage the user kindly after stopping a focus session early.")
-                    send_to_telex(s["channel_id"], f"🛑 Focus session stopped for <@{user_id}>.\n{ai_msg}")
-                    return jsonify({"status": "stopped", "session_id": sid})
+    if session_id:
+        session = get_session(session_id)
+        if not session:
+            return jsonify({"error": "session not found"}), 404
+        with lock:
+            if session.status not in ("running", "focus_completed"):
+                return jsonify({"error": f"session already {session.status}"}), 409
+            session.status = "stopped"
+    else:
+        session = None
+        with lock:
+            for sid in reversed(tuple(USER_SESSIONS.get(user_id, ()))):
+                s = SESSIONS.get(sid)
+                if s is not None and s.status == "running":
+                    s.status = "stopped"
+                    session = s
+                    break
+        if session is None:
             return jsonify({"error": "no running session for user"}), 404
 
+    cancel_job(session.session_id)
+    cancel_job(f"{session.session_id}:brk")
+    dispatch_variant_message(
+        session.channel_id,
+        "stop_early",
+        f"🛑 Focus session stopped for <@{session.user_id}>.\n",
+    )
+    if session_id:
+        return jsonify({"status": "stopped"})
+    return jsonify({"status": "stopped", "session_id": session.session_id})
+
 @app.route("/status/<user_id>", methods=["GET"])
 def status(user_id):
-    with lock:
-        user_sessions = [s for s in SESSIONS.values() if s["user_id"] == user_id]
-    return jsonify({"sessions": user_sessions})
+    user_sessions = user_sessions_of(user_id)
+    return fast_json({"sessions": user_sessions})
 
 @app.route("/enable_daily_summary", methods=["POST"])
 def enable_daily_summary():
@@ -155,34 +443,45 @@ def enable_daily_summary():
     if not user_id or not channel_id:
         return jsonify({"error": "user_id and channel_id required"}), 400
 
+    if not isinstance(time_str, str):
+        return jsonify({"error": "time must be HH:MM"}), 400
+    try:
+        hh, mm = (int(part) for part in time_str.split(":"))
+        trigger = CronTrigger(hour=hh, minute=mm, timezone="UTC")
+    except ValueError:
+        return jsonify({"error": "time must be HH:MM"}), 400
+
     USER_SUMMARIES[user_id] = {"enabled": True, "time": time_str, "channel_id": channel_id}
-    send_to_telex(channel_id, f"🕒 Daily summary enabled for <@{user_id}> at {time_str} UTC.")
+    scheduler.add_job(
+        send_daily_summary,
+        trigger,
+        args=[user_id],
+        id=f"sum:{user_id}",
+        replace_existing=True,
+        misfire_grace_time=300,
+        coalesce=True,
+    )
+    _IO_POOL.submit(send_to_telex, channel_id, f"🕒 Daily summary enabled for <@{user_id}> at {time_str} UTC.")
     return jsonify({"status": "daily_summary_enabled", "time": time_str})
 
-# === Daily summary background worker ===
-def daily_summary_worker():
-    sent_today = set()
-    while True:
-        now = datetime.now()
-        hhmm = now.strftime("%H:%M")
-        with lock:
-            for user_id, cfg in USER_SUMMARIES.items():
-                if not cfg.get("enabled"):
-                    continue
-                if cfg.get("time") == hhmm and (user_id, hhmm) not in sent_today:
-                    completed = [s for s in SESSIONS.values() if s["user_id"] == user_id and s.get("status") in ("completed", "focus_completed")]
-                    total_sessions = len(completed)
-                    total_minutes = sum(s.get("duration", 0) for s in completed)
-                    ai_msg = ai_generate(f"Create an encouraging daily summary for someone who completed {total_sessions} sessions totaling {total_minutes} minutes.")
-                    send_to_telex(cfg["channel_id"], f"📊 Daily Focus Summary: {ai_msg}")
-                    sent_today.add((user_id, hhmm))
-            if hhmm == "00:00":
-                sent_today.clear()
-        time.sleep(30)
-
-# === Start background worker ===
-t = threading.Thread(target=daily_summary_worker, daemon=True)
-t.start()
+# === Daily summary job (one cron job per user) ===
+def send_daily_summary(user_id):
+    cfg = USER_SUMMARIES.get(user_id)
+    if not cfg or not cfg.get("enabled"):
+        return
+    completed = [s for s in user_sessions_of(user_id) if s.status in ("completed", "focus_completed")]
+    total_sessions = len(completed)
+    total_minutes = sum(s.duration for s in completed)
+    # Round minutes to the nearest 15 (never 0 once any time was logged) so the
+    # prompt and its cached reply repeat across users/days; the exact figures go in the prefix.
+    minutes_bucket = max(15, round(total_minutes / 15) * 15) if total_minutes > 0 else 0
+    dispatch_ai_message(
+        cfg["channel_id"],
+        _PROMPT_DAILY_SUMMARY,
+        f"📊 Daily Focus Summary ({total_sessions} sessions, {total_minutes} min): ",
+        batch=True,
+        params={"total_sessions": total_sessions, "minutes_bucket": minutes_bucket},
+    )
 
 @app.route("/webhook", methods=["POST"])
 def webhook():
@@ -190,8 +489,27 @@ def webhook():
     data = request.json or {}
     user_message = data.get("text") or data.get("prompt") or "Hello!"
     ai_reply = ai_generate(user_message)
-    return jsonify({"reply": ai_reply, "timestamp": datetime.now()})
+    return jsonify({"reply": ai_reply, "timestamp": datetime.now(timezone.utc)})
+
+
+# === Background services ===
+# Sessions, timers and summary jobs are per-process state, so the Procfile runs
+# a single gunicorn worker; this guard only keeps one process from starting twice.
+_background_started = False
+_background_lock = threading.Lock()
+
+def start_background():
+    """Start the scheduler and variant preload once per process."""
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    scheduler.start()
+    _IO_POOL.submit(_load_variants)
+
+start_background()
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)), debug=True)
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)), threaded=True)